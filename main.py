@@ -1,23 +1,48 @@
 import os
+import io
+import html
+import re
 import math
 import asyncio
 import logging
+import multiprocessing
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Sequence, Callable, Awaitable
 
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.pool import SimpleConnectionPool
+import msgspec
+import numpy as np
+import asyncpg
+
+# matplotlib опционален: без него не работает только /chart.
+# Agg без GUI-бэкенда, шрифт задан явно, длинные линии рисуются упрощённо и кусками
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    matplotlib.rcParams["font.family"] = "DejaVu Sans"
+    matplotlib.rcParams["path.simplify"] = True
+    matplotlib.rcParams["agg.path.chunksize"] = 10000
+    from matplotlib.figure import Figure
+except ImportError:
+    matplotlib = None
 
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod, GetUpdates
 from aiogram.filters import Command
 from aiogram.types import (
     Message, CallbackQuery,
     ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+    InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 )
 
 # =============== ЛОГИРОВАНИЕ ===============
@@ -28,52 +53,87 @@ log = logging.getLogger("aquaballance")
 load_dotenv()
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 DATABASE_URL = (os.getenv("DATABASE_URL") or "").strip()
+# кэш активного аквариума в памяти процесса; при нескольких инстансах бота выключить (0)
+CACHE_ACTIVE_AQ = os.getenv("CACHE_ACTIVE_AQ", "1") == "1"
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
-# добавим sslmode=require если не указан
-if "sslmode=" not in DATABASE_URL:
-    sep = "&" if "?" in DATABASE_URL else "?"
-    DATABASE_URL = f"{DATABASE_URL}{sep}sslmode=require"
-
 # =============== БД ПУЛ ===============
-db_pool: Optional[SimpleConnectionPool] = None
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "10"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "50"))
+DB_IDLE_TIMEOUT = float(os.getenv("DB_IDLE_TIMEOUT", "300"))
+DB_ACQUIRE_WARN_S = 0.1  # дольше ждали свободное соединение — пул мал для нагрузки, пишем в лог
+db_pool: Optional[asyncpg.Pool] = None
 
-def init_db_pool():
+async def init_db_pool():
     global db_pool
     if db_pool is None:
-        db_pool = SimpleConnectionPool(minconn=1, maxconn=5, dsn=DATABASE_URL)
+        # sslmode из DATABASE_URL asyncpg разбирает сам; если не указан — требуем TLS
+        ssl = None if "sslmode=" in DATABASE_URL else "require"
+        # соединение пересоздаётся после 50k запросов или DB_IDLE_TIMEOUT простоя;
+        # подключение ждём до 10 с, зависший запрос рвём через 60 с
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            max_queries=50000,
+            max_inactive_connection_lifetime=DB_IDLE_TIMEOUT,
+            timeout=10,
+            command_timeout=60,
+            # asyncpg сам готовит и кэширует каждый запрос на соединении; все SQL — константы
+            # модуля (пара десятков), так что держим их в кэше без срока жизни
+            statement_cache_size=256,
+            max_cached_statement_lifetime=0,
+            ssl=ssl,
+        )
         log.info("✅ DB pool created")
 
-def db_exec(sql: str, params: Tuple | None = None, fetch: str = "none"):
+@asynccontextmanager
+async def db_conn():
+    """Соединение из пула; долгое ожидание свободного соединения попадает в лог"""
+    assert db_pool is not None, "DB pool is not initialized"
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    async with db_pool.acquire() as conn:
+        waited = loop.time() - started
+        if waited > DB_ACQUIRE_WARN_S:
+            log.warning("DB pool: %.0f ms waiting for a connection (%d/%d in use)",
+                        waited * 1000, db_pool.get_size() - db_pool.get_idle_size(), DB_POOL_MAX)
+        yield conn
+
+async def adb_exec(sql: str, params: Tuple | None = None, fetch: str = "none"):
     """
-    sync helper (используется в executor ниже)
+    Запрос прямо на event loop через пул asyncpg (плейсхолдеры $1, $2, ...)
     fetch: "one" | "all" | "none"
     """
-    assert db_pool is not None, "DB pool is not initialized"
-    conn = db_pool.getconn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, params or ())
-                if fetch == "one":
-                    return cur.fetchone()
-                if fetch == "all":
-                    return cur.fetchall()
-                return None
-    finally:
-        db_pool.putconn(conn)
+    params = params or ()
+    async with db_conn() as conn:
+        if fetch == "one":
+            return await conn.fetchrow(sql, *params)
+        if fetch == "all":
+            return await conn.fetch(sql, *params)
+        await conn.execute(sql, *params)
+        return None
 
-async def adb_exec(sql: str, params: Tuple | None = None, fetch: str = "none"):
-    """async wrapper чтобы не блокировать event loop"""
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, db_exec, sql, params, fetch)
+async def adb_copy(table: str, columns: Sequence[str], rows: List[Tuple]):
+    """Пакетная вставка через COPY (бинарный протокол asyncpg): все строки одним потоком"""
+    async with db_conn() as conn:
+        await conn.copy_records_to_table(table, records=rows, columns=columns)
 
 # =============== СХЕМА (ensure) ===============
+# Номер версии SCHEMA_SQL: поднимать при каждом изменении DDL ниже, иначе старые базы его не увидят
+_SCHEMA_VERSION = 1
+
 SCHEMA_SQL = r"""
+-- версия применённой схемы: одна строка
+CREATE TABLE IF NOT EXISTS schema_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version INTEGER NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS users (
     user_id BIGINT PRIMARY KEY,
     username TEXT,
@@ -114,6 +174,12 @@ CREATE TABLE IF NOT EXISTS water_settings (
     period_days INTEGER
 );
 
+-- Доля NH3 из TAN, Emerson et al. (1975): pKa = 0.09018 + 2729.92 / (273.15 + T)
+CREATE OR REPLACE FUNCTION nh3_fraction(ph NUMERIC, temp_c NUMERIC) RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT 1.0 / (1.0 + power(10.0, 0.09018 + 2729.92 / (273.15 + temp_c::float8) - ph::float8))
+$$;
+
 -- Измерения воды
 CREATE TABLE IF NOT EXISTS measurements (
     id SERIAL PRIMARY KEY,
@@ -125,36 +191,130 @@ CREATE TABLE IF NOT EXISTS measurements (
     no2 NUMERIC(6,3),
     no3 NUMERIC(6,2),
     tan NUMERIC(6,3),          -- total ammonia (NH3+NH4), mg/L
-    nh3 NUMERIC(6,3),          -- free ammonia, mg/L (расчитываем)
-    nh4 NUMERIC(6,3),          -- ammonium, mg/L (расчитываем)
+    -- free ammonia / ammonium, mg/L: считает БД, NULL если нет tan, ph или температуры
+    nh3 NUMERIC(6,3) GENERATED ALWAYS AS (CASE WHEN tan < 0 THEN 0 ELSE tan END * nh3_fraction(ph, temperature_c)) STORED,
+    nh4 NUMERIC(6,3) GENERATED ALWAYS AS (CASE WHEN tan < 0 THEN 0 ELSE tan END * (1 - nh3_fraction(ph, temperature_c))) STORED,
     po4 NUMERIC(6,2),
     temperature_c NUMERIC(5,2),
     notes TEXT
 );
-CREATE INDEX IF NOT EXISTS idx_meas_aq_time ON measurements(aquarium_id, measured_at DESC);
+
+-- старые базы: nh3/nh4 были обычными колонками, которые заполнял бот
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = 'measurements'
+                 AND column_name = 'nh3' AND is_generated = 'NEVER') THEN
+        ALTER TABLE measurements DROP COLUMN nh3, DROP COLUMN nh4;
+        ALTER TABLE measurements
+            ADD COLUMN nh3 NUMERIC(6,3) GENERATED ALWAYS AS (CASE WHEN tan < 0 THEN 0 ELSE tan END * nh3_fraction(ph, temperature_c)) STORED,
+            ADD COLUMN nh4 NUMERIC(6,3) GENERATED ALWAYS AS (CASE WHEN tan < 0 THEN 0 ELSE tan END * (1 - nh3_fraction(ph, temperature_c))) STORED;
+    END IF;
+END $$;
+-- покрывающий индекс: /chart, /history и последнее измерение читаются index-only scan
+CREATE INDEX IF NOT EXISTS idx_meas_aq_time_cov ON measurements(aquarium_id, measured_at DESC)
+    INCLUDE (ph, kh, gh, no2, no3, tan, nh3, nh4, po4, temperature_c);
+DROP INDEX IF EXISTS idx_meas_aq_time;
+"""
+
+SQL_SCHEMA_VERSION = "SELECT version FROM schema_version"
+SQL_SET_SCHEMA_VERSION = """
+    INSERT INTO schema_version(id, version) VALUES(TRUE, $1)
+    ON CONFLICT (id) DO UPDATE SET version=EXCLUDED.version
 """
 
 async def ensure_schema():
+    """DDL гоняем, только если база отстаёт от _SCHEMA_VERSION; иначе рестарт стоит один SELECT"""
+    try:
+        row = await adb_exec(SQL_SCHEMA_VERSION, fetch="one")
+    except asyncpg.UndefinedTableError:
+        row = None  # база до schema_version или пустая
+    if row and row[0] >= _SCHEMA_VERSION:
+        log.info("DB schema v%d is up to date", row[0])
+        return
     await adb_exec(SCHEMA_SQL)
+    await adb_exec(SQL_SET_SCHEMA_VERSION, (_SCHEMA_VERSION,))
+    log.info("✅ DB schema v%d applied", _SCHEMA_VERSION)
 
-# =============== NH3 / NH4 КАЛЬКУЛЯТОР ===============
-def nh3_fraction(pH: float, temp_c: float) -> float:
-    """
-    Доля NH3 из TAN по формуле Emerson et al. (1975) для пресной воды.
-    pKa = 0.09018 + 2729.92 / (273.15 + T)
-    fraction_NH3 = 1 / (1 + 10^(pKa - pH))
-    """
-    t_k = 273.15 + float(temp_c)
-    pKa = 0.09018 + (2729.92 / t_k)
-    frac = 1.0 / (1.0 + pow(10.0, (pKa - float(pH))))
-    return max(0.0, min(1.0, frac))
-
-def split_tan_to_nh3_nh4(tan: float, pH: float, temp_c: float) -> Tuple[float, float]:
-    tan = max(0.0, float(tan))
-    frac = nh3_fraction(pH, temp_c)
-    nh3 = tan * frac
-    nh4 = tan - nh3
-    return nh3, nh4
+# =============== SQL ===============
+# все запросы — константы модуля: текст один и тот же на каждый вызов и виден в одном месте
+SQL_ENSURE_USER = "INSERT INTO users(user_id, username) VALUES($1,$2) ON CONFLICT (user_id) DO NOTHING"
+SQL_ACTIVE_AQ = "SELECT active_aquarium_id FROM users WHERE user_id=$1"
+SQL_SET_ACTIVE_AQ = "UPDATE users SET active_aquarium_id=$1 WHERE user_id=$2"
+
+SQL_LIST_AQ = "SELECT id, name FROM aquariums WHERE user_id=$1 ORDER BY id"
+SQL_AQ_OWNED = "SELECT 1 FROM aquariums WHERE id=$1 AND user_id=$2"
+# регистрация пользователя, вставка аквариума и выбор активного — одним запросом.
+# FK aquariums -> users проверяется в конце оператора, когда строка users уже есть;
+# username существующего пользователя не трогаем (как в SQL_ENSURE_USER)
+SQL_INSERT_AQ = """
+    WITH a AS (
+        INSERT INTO aquariums(user_id, name, volume_l) VALUES($1,$2,$3) RETURNING id
+    )
+    INSERT INTO users(user_id, username, active_aquarium_id) SELECT $1, $4, id FROM a
+    ON CONFLICT (user_id) DO UPDATE
+        SET active_aquarium_id=COALESCE(users.active_aquarium_id, EXCLUDED.active_aquarium_id)
+    RETURNING active_aquarium_id
+"""
+# удаление и сброс активного одним запросом; строка вернётся, только если аквариум есть и он этого пользователя
+SQL_DELETE_AQ = """
+    WITH d AS (
+        DELETE FROM aquariums WHERE id=$1 AND user_id=$2 RETURNING id
+    ), u AS (
+        UPDATE users SET active_aquarium_id=NULL
+        WHERE user_id=$2 AND active_aquarium_id IN (SELECT id FROM d)
+    )
+    SELECT id FROM d
+"""
+
+# активный аквариум и его последнее измерение за один запрос (m.* — NULL, если измерений нет)
+SQL_ACTIVE_AQ_LAST_MEAS = """
+    SELECT u.active_aquarium_id, m.measured_at,
+           m.ph, m.gh, m.temperature_c, m.no2, m.no3, m.tan, m.nh3, m.nh4, m.po4
+    FROM users u
+    LEFT JOIN LATERAL (
+        SELECT measured_at, ph, gh, temperature_c, no2, no3, tan, nh3, nh4, po4
+        FROM measurements
+        WHERE aquarium_id=u.active_aquarium_id
+        ORDER BY measured_at DESC
+        LIMIT 1
+    ) m ON true
+    WHERE u.user_id=$1
+"""
+# nh3/nh4 — генерируемые колонки, БД возвращает их сразу после вставки
+SQL_INSERT_MEAS = """
+    INSERT INTO measurements (aquarium_id, ph, kh, gh, no2, no3, tan, po4, temperature_c)
+    VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9)
+    RETURNING nh3, nh4
+"""
+COPY_MEAS_COLUMNS = ("aquarium_id", "measured_at", "ph", "kh", "gh", "no2", "no3", "tan", "po4", "temperature_c")
+SQL_HISTORY = """
+    SELECT to_char(measured_at AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI'), ph, kh, gh, no2, no3, tan, nh3, nh4, po4, temperature_c
+    FROM measurements WHERE aquarium_id=$1
+    ORDER BY measured_at DESC LIMIT $2
+"""
+# Строка /history: время уже отформатировано в SQL, остальное — как есть
+_ROW_FMT = "• {}  pH={} KH={} GH={} NO₂={} NO₃={} TAN={} NH₃={} NH₄={} PO₄={} T={}°C".format
+CHART_COLUMNS = {"ph": "ph", "no3": "no3", "nh3": "nh3", "po4": "po4", "t": "temperature_c"}
+# SQL на каждую метрику собираем один раз: колонка берётся только из белого списка.
+# Последние N точек по индексу (DESC), отдаются уже по возрастанию времени — как их рисует график
+SQL_CHART = {
+    metric: f"SELECT measured_at, v FROM ("
+            f"SELECT measured_at, {col} AS v FROM measurements WHERE aquarium_id=$1 AND {col} IS NOT NULL "
+            f"ORDER BY measured_at DESC LIMIT $2"
+            f") last_n ORDER BY measured_at"
+    for metric, col in CHART_COLUMNS.items()
+}
+
+SQL_INSERT_FISH = "INSERT INTO aquarium_fish (aquarium_id, species, qty) VALUES ($1,$2,$3)"
+SQL_INSERT_PLANT = "INSERT INTO aquarium_plants (aquarium_id, species, qty) VALUES ($1,$2,$3)"
+SQL_UPSERT_WATER_SETTINGS = """
+    INSERT INTO water_settings(aquarium_id, change_volume_pct, period_days)
+    VALUES ($1,$2,$3)
+    ON CONFLICT (aquarium_id) DO UPDATE
+    SET change_volume_pct=EXCLUDED.change_volume_pct,
+        period_days=EXCLUDED.period_days
+"""
 
 # =============== СОВМЕСТИМОСТЬ РЫБ/РАСТЕНИЙ (минимальный справочник) ===============
 FISH_GUIDE = {
@@ -172,43 +332,59 @@ PLANT_GUIDE = {
     "элодея": (6.5, 8.0, 4, 18, 18, 28, 1, 20, 0.1, 1.5),
 }
 
-def check_fish_compat(meas: Dict[str, float], species: str) -> Tuple[bool, List[str]]:
-    sp = FISH_GUIDE.get(species.lower())
-    if not sp:
+# Справочники в виде массивов (строка — вид, столбец — проверка): один вид или сразу все
+# сверяются с измерением одним векторным сравнением. Кортежи выше остаются источником данных.
+# (ключ измерения, индекс min в кортеже или None — только верхняя граница, индекс max, текст замечания)
+FISH_CHECKS = (
+    ("ph", 0, 1, "pH вне диапазона {lo}-{hi}"),
+    ("gh", 2, 3, "GH вне диапазона {lo}-{hi}"),
+    ("temperature_c", 4, 5, "Температура вне диапазона {lo}-{hi}°C"),
+    ("no2", None, 6, "NO₂ высокое (> {hi} мг/л)"),
+    ("nh3", None, 7, "NH₃ высокое (> {hi} мг/л)"),
+)
+PLANT_CHECKS = (
+    ("ph", 0, 1, "pH вне диапазона {lo}-{hi}"),
+    ("gh", 2, 3, "GH вне диапазона {lo}-{hi}"),
+    ("temperature_c", 4, 5, "Температура вне диапазона {lo}-{hi}°C"),
+    ("no3", 6, 7, "NO₃ вне диапазона {lo}-{hi} мг/л"),
+    ("po4", 8, 9, "PO₄ вне диапазона {lo}-{hi} мг/л"),
+)
+
+def guide_bounds(guide: Dict[str, tuple], checks: tuple) -> Tuple[np.ndarray, np.ndarray]:
+    """Матрицы нижних/верхних границ формы (видов, проверок); нет нижней границы — -inf"""
+    rows = np.array(list(guide.values()), dtype=np.float64)
+    lo = np.column_stack([rows[:, i] if i is not None else np.full(len(rows), -np.inf) for _, i, _, _ in checks])
+    hi = np.column_stack([rows[:, j] for _, _, j, _ in checks])
+    return lo, hi
+
+FISH_INDEX = {name: k for k, name in enumerate(FISH_GUIDE)}
+FISH_LO, FISH_HI = guide_bounds(FISH_GUIDE, FISH_CHECKS)
+PLANT_INDEX = {name: k for k, name in enumerate(PLANT_GUIDE)}
+PLANT_LO, PLANT_HI = guide_bounds(PLANT_GUIDE, PLANT_CHECKS)
+
+def out_of_bounds(meas: Dict[str, float], checks: tuple, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Маска нарушений той же формы, что lo/hi. Нет значения (None -> NaN) — не нарушение."""
+    v = np.array([meas.get(key) for key, *_ in checks], dtype=np.float64)
+    return (v < lo) | (v > hi)
+
+def check_compat(meas: Dict[str, float], species: str, guide: Dict[str, tuple], index: Dict[str, int],
+                 checks: tuple, lo: np.ndarray, hi: np.ndarray) -> Tuple[bool, List[str]]:
+    k = index.get(species.lower())
+    if k is None:
         return True, [f"Нет справочника по '{species}'. Добавлено без проверки."]
-    ph, gh, t, no2, nh3 = meas.get("ph"), meas.get("gh"), meas.get("temperature_c"), meas.get("no2"), meas.get("nh3")
-    (pH_min, pH_max, GH_min, GH_max, T_min, T_max, NO2_max, NH3_max) = sp
+    sp = guide[species.lower()]
     probs = []
-    if ph is not None and (ph < pH_min or ph > pH_max):
-        probs.append(f"pH вне диапазона {pH_min}-{pH_max}")
-    if gh is not None and (gh < GH_min or gh > GH_max):
-        probs.append(f"GH вне диапазона {GH_min}-{GH_max}")
-    if t is not None and (t < T_min or t > T_max):
-        probs.append(f"Температура вне диапазона {T_min}-{T_max}°C")
-    if no2 is not None and no2 > NO2_max:
-        probs.append(f"NO₂ высокое (> {NO2_max} мг/л)")
-    if nh3 is not None and nh3 > NH3_max:
-        probs.append(f"NH₃ высокое (> {NH3_max} мг/л)")
+    for c in np.flatnonzero(out_of_bounds(meas, checks, lo[k], hi[k])):
+        _, i, j, text = checks[c]
+        # числа — из исходного кортежа, чтобы печатались как в справочнике
+        probs.append(text.format(lo=sp[i] if i is not None else "", hi=sp[j]))
     return (len(probs) == 0), probs
 
+def check_fish_compat(meas: Dict[str, float], species: str) -> Tuple[bool, List[str]]:
+    return check_compat(meas, species, FISH_GUIDE, FISH_INDEX, FISH_CHECKS, FISH_LO, FISH_HI)
+
 def check_plant_compat(meas: Dict[str, float], species: str) -> Tuple[bool, List[str]]:
-    sp = PLANT_GUIDE.get(species.lower())
-    if not sp:
-        return True, [f"Нет справочника по '{species}'. Добавлено без проверки."]
-    ph, gh, t, no3, po4 = meas.get("ph"), meas.get("gh"), meas.get("temperature_c"), meas.get("no3"), meas.get("po4")
-    (pH_min, pH_max, GH_min, GH_max, T_min, T_max, NO3_min, NO3_max, PO4_min, PO4_max) = sp
-    probs = []
-    if ph is not None and (ph < pH_min or ph > pH_max):
-        probs.append(f"pH вне диапазона {pH_min}-{pH_max}")
-    if gh is not None and (gh < GH_min or gh > GH_max):
-        probs.append(f"GH вне диапазона {GH_min}-{GH_max}")
-    if t is not None and (t < T_min or t > T_max):
-        probs.append(f"Температура вне диапазона {T_min}-{T_max}°C")
-    if no3 is not None and (no3 < NO3_min or no3 > NO3_max):
-        probs.append(f"NO₃ вне диапазона {NO3_min}-{NO3_max} мг/л")
-    if po4 is not None and (po4 < PO4_min or po4 > PO4_max):
-        probs.append(f"PO₄ вне диапазона {PO4_min}-{PO4_max} мг/л")
-    return (len(probs) == 0), probs
+    return check_compat(meas, species, PLANT_GUIDE, PLANT_INDEX, PLANT_CHECKS, PLANT_LO, PLANT_HI)
 
 # =============== UI КНОПКИ ===============
 def main_menu() -> ReplyKeyboardMarkup:
@@ -229,54 +405,218 @@ def aquariums_inline(rows: List[Tuple[int, str]], action_prefix: str) -> InlineK
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 # =============== БОТ ===============
-bot = Bot(BOT_TOKEN, parse_mode="HTML")
+# ответы Bot API (в т.ч. каждый getUpdates) декодируем msgspec — это C, а не stdlib json
+session = AiohttpSession(
+    json_loads=msgspec.json.decode,
+    json_dumps=lambda obj: msgspec.json.encode(obj).decode(),
+)
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Исходящие вызовы Bot API не быстрее лимитов Telegram: ~30/с на бота и 20/мин в группу.
+    Берём 28/с с запасом; лишние запросы ждут своей очереди, а не ловят 429 Retry-After.
+    getUpdates не считаем — это наш лонг-поллинг, а не отправка.
+    """
+    def __init__(self):
+        self.limiter = AsyncLimiter(28, 1.0)
+        # лимитеры групп: окно минута, так что простаивающие дольше можно забыть
+        self.groups: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        if isinstance(chat_id, int) and chat_id < 0:
+            # перезапись при каждом обращении продлевает TTL активной группы
+            group = self.groups[chat_id] = self.groups.get(chat_id) or AsyncLimiter(20, 60.0)
+            await group.acquire()
+        async with self.limiter:
+            return await make_request(bot, method)
+
+session.middleware(RateLimitMiddleware())
+bot = Bot(BOT_TOKEN, parse_mode="HTML", session=session)
 dp = Dispatcher()
 r = Router()
 dp.include_router(r)
 
+class ChatOrderMiddleware(BaseMiddleware):
+    """
+    Поллинг запускает каждый апдейт отдельной задачей: чаты не ждут друг друга,
+    но и апдейты одного чата могли обгонять друг друга. Здесь апдейты одного чата
+    идут строго по очереди (asyncio.Lock отдаёт захват в порядке ожидания).
+    Замок живёт, пока в чате есть апдейты в работе.
+    """
+    def __init__(self):
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.pending: Dict[int, int] = {}
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]):
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+        cid = chat.id
+        lock = self.locks.setdefault(cid, asyncio.Lock())
+        self.pending[cid] = self.pending.get(cid, 0) + 1
+        try:
+            async with lock:
+                return await handler(event, data)
+        finally:
+            self.pending[cid] -= 1
+            if not self.pending[cid]:
+                del self.pending[cid], self.locks[cid]
+
+dp.update.outer_middleware(ChatOrderMiddleware())
+
+class ArgvMiddleware(BaseMiddleware):
+    """
+    Аргументы команды (m.text.split()) считаем один раз и отдаём хендлеру как argv.
+    Внутренний мидлварь: срабатывает только когда хендлер уже выбран фильтрами.
+    """
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]):
+        data["argv"] = (getattr(event, "text", None) or "").split()
+        return await handler(event, data)
+
+r.message.middleware(ArgvMiddleware())
+
 # ---------- ВСПОМОГАТЕЛЬНОЕ ----------
+# Готовые PNG /chart по (аквариум, поколение, метрика, N): повтор без новых измерений
+# не ходит ни в БД, ни в matplotlib. Свои вставки сразу увеличивают поколение аквариума,
+# и старые ключи больше не запрашиваются. Записи, которых этот процесс не видел
+# (второй инстанс при деплое, ручная правка в БД), догоняет TTL, как и у кэшей ниже.
+chart_cache: TTLCache = TTLCache(maxsize=256, ttl=60)
+chart_gen: Dict[int, int] = {}
+
+def invalidate_charts(aq_id: int):
+    chart_gen[aq_id] = chart_gen.get(aq_id, 0) + 1
+
+# Список аквариумов пользователя: меню дёргают часто, меняется он только через
+# /add_aquarium, поэтому держим минуту и сбрасываем при изменении
+aq_list_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+# Активный аквариум нужен почти каждой команде, а меняют его только
+# setactive, /add_aquarium и /del_aquarium — они же и обновляют кэш
+active_aq_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+
+def remember_active_aq(user_id: int, aq_id: Optional[int]):
+    if CACHE_ACTIVE_AQ:
+        active_aq_cache[user_id] = aq_id
+
+async def list_user_aquariums(user_id: int, username: Optional[str]) -> List[Tuple[int, str]]:
+    rows = aq_list_cache.get(user_id)
+    if rows is None:
+        # регистрация и выборка независимы: идут параллельно на разных соединениях пула
+        _, recs = await asyncio.gather(
+            ensure_user(user_id, username),
+            adb_exec(SQL_LIST_AQ, (user_id,), "all"),
+        )
+        rows = aq_list_cache[user_id] = [(rec[0], rec[1]) for rec in recs]
+    return rows
+
 async def ensure_user(user_id: int, username: Optional[str]):
-    row = await adb_exec("SELECT 1 FROM users WHERE user_id=%s", (user_id,), "one")
-    if not row:
-        await adb_exec("INSERT INTO users(user_id, username) VALUES(%s,%s)", (user_id, username), "none")
+    await adb_exec(SQL_ENSURE_USER, (user_id, username))
 
 async def get_active_aq(user_id: int) -> Optional[int]:
-    row = await adb_exec("SELECT active_aquarium_id FROM users WHERE user_id=%s", (user_id,), "one")
-    if row and row[0]:
-        return int(row[0])
-    return None
-
-async def get_last_meas(aq_id: int) -> Optional[Dict[str, float]]:
-    row = await adb_exec("""
-        SELECT ph, gh, temperature_c, no2, no3, tan, nh3, nh4, po4
-        FROM measurements
-        WHERE aquarium_id=%s
-        ORDER BY measured_at DESC
-        LIMIT 1
-    """, (aq_id,), "one")
-    if not row:
-        return None
+    if CACHE_ACTIVE_AQ and user_id in active_aq_cache:
+        return active_aq_cache[user_id]
+    row = await adb_exec(SQL_ACTIVE_AQ, (user_id,), "one")
+    aq_id = int(row[0]) if row and row[0] else None
+    remember_active_aq(user_id, aq_id)
+    return aq_id
+
+async def get_active_aq_last_meas(user_id: int) -> Tuple[Optional[int], Optional[Dict[str, float]]]:
+    """(активный аквариум, его последнее измерение) — None там, чего нет"""
+    row = await adb_exec(SQL_ACTIVE_AQ_LAST_MEAS, (user_id,), "one")
+    remember_active_aq(user_id, int(row[0]) if row and row[0] else None)
+    if not row or not row[0]:
+        return None, None
+    if row[1] is None:
+        return int(row[0]), None
     cols = ["ph", "gh", "temperature_c", "no2", "no3", "tan", "nh3", "nh4", "po4"]
-    return {cols[i]: (None if row[i] is None else float(row[i])) for i in range(len(cols))}
+    return int(row[0]), {c: (None if v is None else float(v)) for c, v in zip(cols, row[2:])}
+
+async def create_aquarium(user_id: int, username: Optional[str], name: str, volume: Optional[float]):
+    row = await adb_exec(SQL_INSERT_AQ, (user_id, name, volume, username), "one")
+    aq_list_cache.pop(user_id, None)
+    remember_active_aq(user_id, row[0])
+
+# токен целиком "ключ=число"; запятая как десятичный разделитель тоже допустима
+_KV_RE = re.compile(r"(?<!\S)([A-Za-z_][A-Za-z0-9_]*)=([-+]?(?:\d+(?:[.,]\d*)?|[.,]\d+)(?:[eE][-+]?\d+)?)(?!\S)")
+_KV_KEYS = frozenset({"ph", "gh", "kh", "no2", "no3", "tan", "po4", "t", "temp", "temperature", "temperature_c"})
 
 def parse_kv_args(s: str) -> Dict[str, float]:
     """
     Пример: "ph=7.2 gh=8 kh=4 no2=0.02 no3=10 tan=0.2 po4=0.5 t=25"
-    Ключи: ph, gh, kh, no2, no3, tan, po4, t|temp
+    Ключи: ph, gh, kh, no2, no3, tan, po4, t|temp. Неизвестные ключи и не-числа пропускаются.
     """
     out = {}
-    for chunk in s.split():
-        if "=" not in chunk:
-            continue
-        k, v = chunk.split("=", 1)
-        k = k.strip().lower()
-        v = v.strip().replace(",", ".")
-        try:
-            out[k] = float(v)
-        except:
-            pass
+    for k, v in _KV_RE.findall(s):
+        k = k.lower()
+        if k in _KV_KEYS:
+            out[k] = float(v.replace(",", "."))
     return out
 
+# колонки CSV после даты — в том же порядке, что и в /add_measure
+CSV_COLUMNS = ("ph", "kh", "gh", "no2", "no3", "tan", "po4", "temperature_c")
+CSV_MAX_BYTES = 1024 * 1024
+
+def parse_measurements_csv(s: str) -> Tuple[List[datetime], np.ndarray]:
+    """
+    Строки вида "2024-05-01 10:00,7.2,4,8,0.02,10,0.2,0.5,25".
+    Заголовок (первая строка не с цифры) пропускается. Пустое поле -> NaN.
+    Возвращает даты и массив значений формы (N, 8). Бросает ValueError с номером строки,
+    если полей не 9, дата кривая или значение не конечное число (как parse_positional_args).
+    """
+    numbered = [(n, ln.strip()) for n, ln in enumerate(s.splitlines(), 1) if ln.strip()]
+    if numbered and not numbered[0][1][0].isdigit():
+        numbered = numbered[1:]
+    if not numbered:
+        raise ValueError("нет строк с данными")
+    width = 1 + len(CSV_COLUMNS)
+    dates, cells = [], []
+    for n, ln in numbered:
+        fields = [f.strip() for f in ln.split(",")]
+        if len(fields) != width:
+            raise ValueError(f"строка {n}: нужно {width} полей, получено {len(fields)}")
+        try:
+            dates.append(datetime.fromisoformat(fields[0]))
+        except ValueError:
+            raise ValueError(f"строка {n}: неверная дата «{fields[0]}»") from None
+        cells.append(fields[1:])
+    raw = np.array(cells)
+    empty = raw == ""
+    # NaN — только у пустых полей; остальное переводим в числа одним преобразованием numpy
+    try:
+        vals = np.where(empty, "nan", raw).astype(np.float64)
+    except ValueError:
+        vals = None
+    if vals is None or not (np.isfinite(vals) | empty).all():
+        for (n, _), row in zip(numbered, cells):
+            for v in row:
+                try:
+                    ok = not v or math.isfinite(float(v))
+                except ValueError:
+                    ok = False
+                if not ok:
+                    raise ValueError(f"строка {n}: «{v}» — не конечное число")
+    return dates, vals
+
+def parse_positional_args(s: str) -> Dict[str, float]:
+    """
+    Пример: "7.2 4 8 0.02 10 0.2 0.5 25" — все 8 значений по порядку CSV_COLUMNS.
+    Бросает ValueError, если значений не 8 или есть не-число (в т.ч. nan/inf).
+    """
+    parts = s.replace(",", ".").split()
+    if len(parts) != len(CSV_COLUMNS):
+        raise ValueError(f"нужно {len(CSV_COLUMNS)} значений, получено {len(parts)}")
+    # весь набор — одним преобразованием numpy, без float() на каждое значение
+    vals = np.array(parts, dtype=np.float64)
+    if not np.isfinite(vals).all():
+        raise ValueError("значения должны быть конечными числами")
+    return dict(zip(CSV_COLUMNS, vals.tolist()))
+
+def nan_to_none(a: np.ndarray) -> List[Optional[float]]:
+    return [None if math.isnan(v) else v for v in a.tolist()]
+
 # ---------- КОМАНДЫ ----------
 @r.message(Command("start"))
 async def cmd_start(m: Message):
@@ -287,7 +627,10 @@ async def cmd_start(m: Message):
         "Команды:\n"
         "• /add_aquarium <название> [объём_л]\n"
         "• /list_aquariums — список и выбор активного\n"
+        "• /del_aquarium <id> — удалить аквариум\n"
         "• /add_measure ph=.. gh=.. kh=.. no2=.. no3=.. tan=.. po4=.. t=..\n"
+        "   или все 8 значений подряд: /add_measure 7.2 4 8 0.02 10 0.2 0.5 25\n"
+        "• /import_csv — импорт измерений из CSV текстом или файлом (дата,ph,kh,gh,no2,no3,tan,po4,t)\n"
         "• /history [N] — последние N измерений (по умолчанию 5)\n"
         "• /add_fish <вид> <кол-во>\n"
         "• /add_plant <вид> <кол-во>\n"
@@ -296,36 +639,30 @@ async def cmd_start(m: Message):
         reply_markup=main_menu()
     )
 
-@r.message(F.text == "📃 Аквариумы")
 @r.message(Command("list_aquariums"))
 async def list_aquariums(m: Message):
-    await ensure_user(m.from_user.id, m.from_user.username)
-    rows = await adb_exec("SELECT id, name FROM aquariums WHERE user_id=%s ORDER BY id", (m.from_user.id,), "all")
+    rows = await list_user_aquariums(m.from_user.id, m.from_user.username)
     if not rows:
         await m.answer("У тебя пока нет аквариумов. Добавь: /add_aquarium <название> [объём_л]")
         return
-    kb = aquariums_inline([(r[0], r[1]) for r in rows], "setactive")
+    kb = aquariums_inline(rows, "setactive")
     await m.answer("Выбери активный аквариум:", reply_markup=kb)
 
 @r.callback_query(F.data.startswith("setactive:"))
 async def set_active_cb(cq: CallbackQuery):
     aq_id = int(cq.data.split(":")[1])
     # проверим, что аквариум принадлежит пользователю
-    row = await adb_exec("SELECT 1 FROM aquariums WHERE id=%s AND user_id=%s", (aq_id, cq.from_user.id), "one")
+    row = await adb_exec(SQL_AQ_OWNED, (aq_id, cq.from_user.id), "one")
     if not row:
         await cq.answer("Нет доступа.", show_alert=True)
         return
-    await adb_exec("UPDATE users SET active_aquarium_id=%s WHERE user_id=%s", (aq_id, cq.from_user.id))
+    await adb_exec(SQL_SET_ACTIVE_AQ, (aq_id, cq.from_user.id))
+    remember_active_aq(cq.from_user.id, aq_id)
     await cq.message.edit_text(f"Активный аквариум: <b>{aq_id}</b>")
     await cq.answer("Готово!")
 
-@r.message(F.text == "➕ Аквариум")
-async def shortcut_add_aq(m: Message):
-    await m.answer("Использование: /add_aquarium <название> [объём_л]")
-
 @r.message(Command("add_aquarium"))
 async def add_aquarium(m: Message):
-    await ensure_user(m.from_user.id, m.from_user.username)
     parts = (m.text or "").split(maxsplit=2)
     if len(parts) < 2:
         await m.answer("Использование: /add_aquarium <название> [объём_л]")
@@ -337,23 +674,29 @@ async def add_aquarium(m: Message):
             volume = float(parts[2].replace(",", "."))
         except:
             volume = None
-    await adb_exec(
-        "INSERT INTO aquariums(user_id, name, volume_l) VALUES(%s,%s,%s)",
-        (m.from_user.id, name, volume)
-    )
-    # если активного нет — назначим
-    active = await get_active_aq(m.from_user.id)
-    if not active:
-        row = await adb_exec("SELECT id FROM aquariums WHERE user_id=%s ORDER BY id DESC LIMIT 1",
-                             (m.from_user.id,), "one")
-        if row:
-            await adb_exec("UPDATE users SET active_aquarium_id=%s WHERE user_id=%s", (row[0], m.from_user.id))
+    # подтверждение — только после успешной записи: упавший INSERT не должен выглядеть как «добавлен»
+    await create_aquarium(m.from_user.id, m.from_user.username, name, volume)
     await m.answer(f"✅ Аквариум «{name}» добавлен.", reply_markup=main_menu())
 
-@r.message(F.text == "🧪 Измерение")
-async def shortcut_measure(m: Message):
-    await m.answer("Пример:\n"
-                   "<code>/add_measure ph=7.2 gh=8 kh=4 no2=0.02 no3=10 tan=0.2 po4=0.5 t=25</code>")
+@r.message(Command("del_aquarium"))
+async def del_aquarium(m: Message, argv: List[str]):
+    try:
+        aq_id = int(argv[1])
+    except:
+        await m.answer("Использование: /del_aquarium <id> (id — в /list_aquariums)")
+        return
+    # id вне диапазона SERIAL (int4) в БД не отправляем — такого аквариума нет
+    row = None
+    if 0 < aq_id < 2**31:
+        row = await adb_exec(SQL_DELETE_AQ, (aq_id, m.from_user.id), "one")
+    if not row:
+        await m.answer("Аквариум не найден.")
+        return
+    aq_list_cache.pop(m.from_user.id, None)
+    active_aq_cache.pop(m.from_user.id, None)
+    # id из SERIAL не переиспользуются, так что поколение графиков удалённого можно забыть
+    chart_gen.pop(aq_id, None)
+    await m.answer(f"🗑 Аквариум {aq_id} удалён вместе с измерениями и жителями.")
 
 @r.message(Command("add_measure"))
 async def add_measure(m: Message):
@@ -362,7 +705,16 @@ async def add_measure(m: Message):
     if not aq_id:
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
-    kv = parse_kv_args(m.text or "")
+    args = (m.text or "").partition(" ")[2]
+    if args.strip() and "=" not in args:
+        try:
+            kv = parse_positional_args(args)
+        except ValueError as e:
+            await m.answer(f"Не удалось разобрать значения: {e}\n"
+                           "Порядок: ph kh gh no2 no3 tan po4 t")
+            return
+    else:
+        kv = parse_kv_args(args)
     # маппинг допустимых ключей
     ph = kv.get("ph")
     kh = kv.get("kh")
@@ -372,58 +724,75 @@ async def add_measure(m: Message):
     tan = kv.get("tan")
     po4 = kv.get("po4")
     t = kv.get("t") or kv.get("temp") or kv.get("temperature") or kv.get("temperature_c")
-    nh3 = nh4 = None
-    if tan is not None and ph is not None and t is not None:
-        nh3, nh4 = split_tan_to_nh3_nh4(tan, ph, t)
-
-    await adb_exec("""
-        INSERT INTO measurements (aquarium_id, ph, kh, gh, no2, no3, tan, nh3, nh4, po4, temperature_c)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-    """, (aq_id, ph, kh, gh, no2, no3, tan, nh3, nh4, po4, t))
+
+    nh3, nh4 = await adb_exec(SQL_INSERT_MEAS, (aq_id, ph, kh, gh, no2, no3, tan, po4, t), "one")
     txt = "✅ Измерение сохранено."
     if nh3 is not None and nh4 is not None:
         txt += f"\nРасчёт: NH₃={nh3:.3f} мг/л, NH₄={nh4:.3f} мг/л"
+    invalidate_charts(aq_id)
     await m.answer(txt)
 
+@r.message(Command("import_csv"))
+async def import_csv(m: Message):
+    user_id = m.from_user.id
+    aq_id = await get_active_aq(user_id)
+    if not aq_id:
+        await m.answer("Сначала выбери активный аквариум: /list_aquariums")
+        return
+    if m.document:
+        # файл с подписью /import_csv: Command смотрит и в caption
+        if (m.document.file_size or 0) > CSV_MAX_BYTES:
+            await m.answer(f"Файл больше {CSV_MAX_BYTES // 1024} КБ — раздели его на части.")
+            return
+        buf = await bot.download(m.document)
+        try:
+            body = buf.read().decode("utf-8-sig")
+        except UnicodeDecodeError:
+            await m.answer("Файл должен быть CSV в кодировке UTF-8.")
+            return
+    else:
+        body = (m.text or "").partition("\n")[2]
+    if not body.strip():
+        await m.answer("Использование: /import_csv, со следующей строки — по измерению на строку:\n"
+                       "<code>2024-05-01 10:00,7.2,4,8,0.02,10,0.2,0.5,25</code>\n"
+                       "(дата,ph,kh,gh,no2,no3,tan,po4,t; пустое поле — нет значения)\n"
+                       "Или пришли .csv файлом с подписью /import_csv.")
+        return
+    try:
+        dates, vals = parse_measurements_csv(body)
+    except ValueError as e:
+        await m.answer(f"Не удалось разобрать CSV: {html.escape(str(e))}")
+        return
+
+    cols = [nan_to_none(vals[:, i]) for i in range(vals.shape[1])]
+    rows = [(aq_id, dt) + tuple(vs) for dt, *vs in zip(dates, *cols)]
+    await adb_copy("measurements", COPY_MEAS_COLUMNS, rows)
+    invalidate_charts(aq_id)
+    await m.answer(f"✅ Импортировано измерений: {len(rows)}.")
+
 @r.message(Command("history"))
-async def history(m: Message):
+async def history(m: Message, argv: List[str]):
     user_id = m.from_user.id
     aq_id = await get_active_aq(user_id)
     if not aq_id:
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
-    parts = (m.text or "").split()
     limit = 5
-    if len(parts) == 2:
+    if len(argv) == 2:
         try:
-            limit = max(1, min(30, int(parts[1])))
+            limit = max(1, min(30, int(argv[1])))
         except:
             pass
-    rows = await adb_exec("""
-        SELECT measured_at, ph, kh, gh, no2, no3, tan, nh3, nh4, po4, temperature_c
-        FROM measurements WHERE aquarium_id=%s
-        ORDER BY measured_at DESC LIMIT %s
-    """, (aq_id, limit), "all")
+    rows = await adb_exec(SQL_HISTORY, (aq_id, limit), "all")
     if not rows:
         await m.answer("История пуста. Добавь измерение: /add_measure ...")
         return
-    lines = []
-    for r in rows:
-        t = r[0].strftime("%Y-%m-%d %H:%M")
-        ph, kh, gh, no2, no3, tan, nh3, nh4, po4, tc = r[1:11]
-        lines.append(
-            f"• {t}  pH={ph} KH={kh} GH={gh} NO₂={no2} NO₃={no3} TAN={tan} NH₃={nh3} NH₄={nh4} PO₄={po4} T={tc}°C"
-        )
-    await m.answer("Последние измерения:\n" + "\n".join(lines))
-
-@r.message(F.text == "🐟 Добавить рыбу")
-async def shortcut_fish(m: Message):
-    await m.answer("Пример: <code>/add_fish гуппи 5</code>")
+    await m.answer("Последние измерения:\n" + "\n".join(_ROW_FMT(*r) for r in rows))
 
 @r.message(Command("add_fish"))
 async def add_fish(m: Message):
     user_id = m.from_user.id
-    aq_id = await get_active_aq(user_id)
+    aq_id, last = await get_active_aq_last_meas(user_id)
     if not aq_id:
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
@@ -435,26 +804,25 @@ async def add_fish(m: Message):
     try:
         qty = int(parts[2])
     except:
-        await m.answer("Количество должно быть целым числом.")
+        qty = 0
+    if qty <= 0:
+        await m.answer("Количество должно быть целым положительным числом.")
         return
 
     # проверка совместимости на основе последних измерений
-    meas = await get_last_meas(aq_id) or {}
+    meas = last or {}
     ok, probs = check_fish_compat(meas, species)
-    await adb_exec("INSERT INTO aquarium_fish (aquarium_id, species, qty) VALUES (%s,%s,%s)", (aq_id, species, qty))
     if ok:
-        await m.answer(f"✅ «{species}» x{qty} добавлены. Совместимость: OK.")
+        reply = f"✅ «{species}» x{qty} добавлены. Совместимость: OK."
     else:
-        await m.answer("⚠️ Добавлены, но есть замечания:\n- " + "\n- ".join(probs))
-
-@r.message(F.text == "🌿 Добавить растение")
-async def shortcut_plant(m: Message):
-    await m.answer("Пример: <code>/add_plant анубиас 3</code>")
+        reply = "⚠️ Добавлены, но есть замечания:\n- " + "\n- ".join(probs)
+    await adb_exec(SQL_INSERT_FISH, (aq_id, species, qty))
+    await m.answer(reply)
 
 @r.message(Command("add_plant"))
 async def add_plant(m: Message):
     user_id = m.from_user.id
-    aq_id = await get_active_aq(user_id)
+    aq_id, last = await get_active_aq_last_meas(user_id)
     if not aq_id:
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
@@ -466,58 +834,46 @@ async def add_plant(m: Message):
     try:
         qty = int(parts[2])
     except:
-        await m.answer("Количество должно быть целым числом.")
+        qty = 0
+    if qty <= 0:
+        await m.answer("Количество должно быть целым положительным числом.")
         return
 
-    meas = await get_last_meas(aq_id) or {}
+    meas = last or {}
     ok, probs = check_plant_compat(meas, species)
-    await adb_exec("INSERT INTO aquarium_plants (aquarium_id, species, qty) VALUES (%s,%s,%s)", (aq_id, species, qty))
     if ok:
-        await m.answer(f"✅ «{species}» x{qty} добавлены. Совместимость: OK.")
+        reply = f"✅ «{species}» x{qty} добавлены. Совместимость: OK."
     else:
-        await m.answer("⚠️ Добавлены, но есть замечания:\n- " + "\n- ".join(probs))
-
-@r.message(F.text == "⚙️ Настройки")
-async def shortcut_settings(m: Message):
-    await m.answer("Пример:\n"
-                   "<code>/set_water_change 30 7</code>\n"
-                   "означает 30% каждые 7 дней.")
+        reply = "⚠️ Добавлены, но есть замечания:\n- " + "\n- ".join(probs)
+    await adb_exec(SQL_INSERT_PLANT, (aq_id, species, qty))
+    await m.answer(reply)
 
 @r.message(Command("set_water_change"))
-async def set_water_change(m: Message):
+async def set_water_change(m: Message, argv: List[str]):
     user_id = m.from_user.id
     aq_id = await get_active_aq(user_id)
     if not aq_id:
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
-    parts = (m.text or "").split()
-    if len(parts) != 3:
+    if len(argv) != 3:
         await m.answer("Использование: /set_water_change <процент> <период_дней>")
         return
     try:
-        pct = float(parts[1].replace(",", "."))
-        days = int(parts[2])
+        pct = float(argv[1].replace(",", "."))
+        days = int(argv[2])
     except:
         await m.answer("Проверь формат чисел.")
         return
-    await adb_exec("""
-        INSERT INTO water_settings(aquarium_id, change_volume_pct, period_days)
-        VALUES (%s,%s,%s)
-        ON CONFLICT (aquarium_id) DO UPDATE
-        SET change_volume_pct=EXCLUDED.change_volume_pct,
-            period_days=EXCLUDED.period_days
-    """, (aq_id, pct, days))
+    await adb_exec(SQL_UPSERT_WATER_SETTINGS, (aq_id, pct, days))
     await m.answer(f"✅ Настройки подмен сохранены: {pct}% каждые {days} дн.")
 
-@r.message(F.text == "💡 Советы")
 @r.message(Command("suggest"))
 async def suggest(m: Message):
     user_id = m.from_user.id
-    aq_id = await get_active_aq(user_id)
+    aq_id, meas = await get_active_aq_last_meas(user_id)
     if not aq_id:
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
-    meas = await get_last_meas(aq_id)
     if not meas:
         await m.answer("Нет измерений. Добавь: /add_measure ...")
         return
@@ -534,19 +890,55 @@ async def suggest(m: Message):
         tips.append("Показатели в норме для большинства неприхотливых рыб. Продолжай наблюдение.")
     await m.answer("Рекомендации:\n- " + "\n- ".join(tips))
 
-# (опционально) простой график одной метрики
-@r.message(F.text == "📈 График")
-async def shortcut_chart(m: Message):
-    await m.answer("Пример: <code>/chart ph 20</code> (метрика и количество точек)")
+# Рендер — CPU на сотни мс, поэтому идёт в отдельных процессах и не держит event loop.
+# spawn, а не fork: рабочему не нужны копии сокетов пула БД и потоков aiohttp
+CHART_WORKERS = 2
+chart_pool: Optional[ProcessPoolExecutor] = None
 
-@r.message(Command("chart"))
-async def chart_cmd(m: Message):
+# одна Figure/Axes на процесс: между графиками только очищаем оси
+_chart_fig = None
+_chart_ax = None
+
+def chart_axes():
+    global _chart_fig, _chart_ax
+    if _chart_fig is None:
+        _chart_fig = Figure()
+        _chart_ax = _chart_fig.add_subplot()
+    return _chart_fig, _chart_ax
+
+def warm_chart_worker():
+    """Поднять процесс заранее: импорт matplotlib и первая Figure — не на первом /chart"""
+    chart_axes()
+
+def log_warm_failure(fut: Future):
+    """Колбэк прогрева: рабочий, не сумевший импортировать main/matplotlib, виден в логе при старте"""
     try:
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-    except Exception as e:
-        await m.answer(f"Модуль matplotlib не установлен: {e}")
+        fut.result()
+    except CancelledError:
+        pass
+    except Exception:
+        log.exception("chart worker failed to start")
+
+def render_chart(metric: str, xs: List[datetime], ys: np.ndarray) -> bytes:
+    """
+    PNG графика одной метрики.
+    Выполняется в процессе chart_pool; задачи в процессе идут по одной, поэтому общая Figure без блокировки.
+    """
+    fig, ax = chart_axes()
+    ax.clear()
+    ax.plot(xs, ys, marker="o")
+    ax.set_title(f"{metric.upper()} динамика")
+    ax.set_xlabel("Дата")
+    ax.set_ylabel(metric.upper())
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+@r.message(Command("chart"))
+async def chart_cmd(m: Message, argv: List[str]):
+    if matplotlib is None:
+        await m.answer("Модуль matplotlib не установлен.")
         return
 
     user_id = m.from_user.id
@@ -555,68 +947,112 @@ async def chart_cmd(m: Message):
         await m.answer("Сначала выбери активный аквариум: /list_aquariums")
         return
 
-    parts = (m.text or "").split()
-    if len(parts) < 2:
+    if len(argv) < 2:
         await m.answer("Использование: /chart <метрика> [N]. Метрики: ph, no3, nh3, po4, t")
         return
-    metric = parts[1].lower()
-    key_map = {"ph":"ph","no3":"no3","nh3":"nh3","po4":"po4","t":"temperature_c"}
-    col = key_map.get(metric)
-    if not col:
+    metric = argv[1].lower()
+    sql = SQL_CHART.get(metric)
+    if not sql:
         await m.answer("Неизвестная метрика. Доступно: ph, no3, nh3, po4, t")
         return
     limit = 20
-    if len(parts) >= 3:
+    if len(argv) >= 3:
         try:
-            limit = max(3, min(100, int(parts[2])))
+            limit = max(3, min(100, int(argv[2])))
         except:
             pass
 
-    rows = await adb_exec(
-        f"SELECT measured_at, {col} FROM measurements WHERE aquarium_id=%s AND {col} IS NOT NULL ORDER BY measured_at DESC LIMIT %s",
-        (aq_id, limit),
-        "all"
-    )
-    if not rows:
-        await m.answer("Нет данных для графика.")
-        return
+    key = (aq_id, chart_gen.get(aq_id, 0), metric, limit)
+    png = chart_cache.get(key)
+    if png is None:
+        rows = await adb_exec(sql, (aq_id, limit), "all")
+        if not rows:
+            await m.answer("Нет данных для графика.")
+            return
+        # даты отдаём matplotlib как есть; значения (NUMERIC -> Decimal) — сразу в float64-массив
+        xs = [r[0] for r in rows]
+        ys = np.fromiter((r[1] for r in rows), dtype=np.float64, count=len(rows))
+        loop = asyncio.get_running_loop()
+        try:
+            png = chart_cache[key] = await loop.run_in_executor(chart_pool, render_chart, metric, xs, ys)
+        except BrokenProcessPool:
+            log.exception("chart pool is broken")
+            await m.answer("Графики сейчас недоступны: не запустился процесс отрисовки.")
+            return
+    await bot.send_photo(m.chat.id, BufferedInputFile(png, filename="chart.png"))
 
-    xs = [r[0] for r in rows][::-1]
-    ys = [float(r[1]) for r in rows][::-1]
-
-    # рисуем
-    import matplotlib.pyplot as plt
-    plt.figure()
-    plt.plot(xs, ys, marker="o")
-    plt.title(f"{metric.upper()} динамика")
-    plt.xlabel("Дата")
-    plt.ylabel(metric.upper())
-    plt.tight_layout()
-    path = "/tmp/chart.png"
-    plt.savefig(path)
-    plt.close()
-    await bot.send_photo(m.chat.id, FSInputFile(path))
+# ---------- КНОПКИ МЕНЮ ----------
+# вместо фильтра F.text == "..." на каждую кнопку — один хендлер и поиск по словарю
+# Кнопки-подсказки: статический ответ без обращения к БД
+_SHORTCUT_REPLIES = {
+    "➕ Аквариум": "Использование: /add_aquarium <название> [объём_л]",
+    "🧪 Измерение": ("Пример:\n"
+                    "<code>/add_measure ph=7.2 gh=8 kh=4 no2=0.02 no3=10 tan=0.2 po4=0.5 t=25</code>\n"
+                    "или по порядку ph kh gh no2 no3 tan po4 t:\n"
+                    "<code>/add_measure 7.2 4 8 0.02 10 0.2 0.5 25</code>"),
+    "📈 График": "Пример: <code>/chart ph 20</code> (метрика и количество точек)",
+    "🐟 Добавить рыбу": "Пример: <code>/add_fish гуппи 5</code>",
+    "🌿 Добавить растение": "Пример: <code>/add_plant анубиас 3</code>",
+    "⚙️ Настройки": ("Пример:\n"
+                    "<code>/set_water_change 30 7</code>\n"
+                    "означает 30% каждые 7 дней."),
+}
+
+# Кнопки, которые вызывают полноценный обработчик
+MENU_HANDLERS = {
+    "📃 Аквариумы": list_aquariums,
+    "💡 Советы": suggest,
+}
+
+MENU_BUTTONS = frozenset(_SHORTCUT_REPLIES) | frozenset(MENU_HANDLERS)
+
+@r.message(F.text.in_(MENU_BUTTONS))
+async def menu_button(m: Message):
+    reply = _SHORTCUT_REPLIES.get(m.text)
+    if reply is not None:
+        await m.answer(reply)
+        return
+    await MENU_HANDLERS[m.text](m)
 
 # =============== FASTAPI APP ДЛЯ HEALTH + ЖИЗНЕННОГО ПОРТА ===============
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # uvicorn[standard] ставит uvloop, а loop="auto" берёт его сам; в логе видно, какой цикл вышел
+    log.info("event loop: %s", type(asyncio.get_running_loop()).__module__)
+    global chart_pool
+    await init_db_pool()
+    await ensure_schema()
+    if matplotlib is not None:
+        chart_pool = ProcessPoolExecutor(CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        for _ in range(CHART_WORKERS):
+            chart_pool.submit(warm_chart_worker).add_done_callback(log_warm_failure)
+    # Стартуем лонг-поллинг как фоновую задачу; сигналы остаются за uvicorn.
+    # getUpdates ждёт до 30 с на стороне Telegram: в простое ~2 запроса в минуту вместо 6
+    poller = asyncio.create_task(dp.start_polling(
+        bot, polling_timeout=30, allowed_updates=dp.resolve_used_update_types(), handle_signals=False
+    ))
+    try:
+        yield
+    finally:
+        poller.cancel()
+        try:
+            await asyncio.wait_for(poller, 5)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            log.exception("polling task failed on shutdown")
+        if chart_pool:
+            chart_pool.shutdown(wait=False, cancel_futures=True)
+        if db_pool:
+            await db_pool.close()
+        await bot.session.close()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/health")
 async def health():
     return JSONResponse({"ok": True, "service": "aquaballance-bot"})
 
-@app.on_event("startup")
-async def on_startup():
-    init_db_pool()
-    await ensure_schema()
-    # Стартуем лонг-поллинг как фоновую задачу
-    asyncio.create_task(dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types()))
-
-@app.on_event("shutdown")
-async def on_shutdown():
-    if db_pool:
-        db_pool.closeall()
-    await bot.session.close()
-
 # Локальный запуск: uvicorn main:app --reload
 if __name__ == "__main__":
     # локально можно просто поднять uvicorn
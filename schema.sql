@@ -1,4 +1,10 @@
 -- Создание пользователей, аквариумов, обитателей, измерений, настроек подмен
+-- версия применённой схемы (её пишет бот при старте): одна строка
+CREATE TABLE IF NOT EXISTS schema_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version INTEGER NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS users (
     user_id BIGINT PRIMARY KEY,
     username TEXT,
@@ -38,6 +44,11 @@ CREATE TABLE IF NOT EXISTS water_settings (
     period_days INTEGER
 );
 
+CREATE OR REPLACE FUNCTION nh3_fraction(ph NUMERIC, temp_c NUMERIC) RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT 1.0 / (1.0 + power(10.0, 0.09018 + 2729.92 / (273.15 + temp_c::float8) - ph::float8))
+$$;
+
 CREATE TABLE IF NOT EXISTS measurements (
     id SERIAL PRIMARY KEY,
     aquarium_id INTEGER NOT NULL REFERENCES aquariums(id) ON DELETE CASCADE,
@@ -48,10 +59,11 @@ CREATE TABLE IF NOT EXISTS measurements (
     no2 NUMERIC(6,3),
     no3 NUMERIC(6,2),
     tan NUMERIC(6,3),
-    nh3 NUMERIC(6,3),
-    nh4 NUMERIC(6,3),
+    nh3 NUMERIC(6,3) GENERATED ALWAYS AS (CASE WHEN tan < 0 THEN 0 ELSE tan END * nh3_fraction(ph, temperature_c)) STORED,
+    nh4 NUMERIC(6,3) GENERATED ALWAYS AS (CASE WHEN tan < 0 THEN 0 ELSE tan END * (1 - nh3_fraction(ph, temperature_c))) STORED,
     po4 NUMERIC(6,2),
     temperature_c NUMERIC(5,2),
     notes TEXT
 );
-CREATE INDEX IF NOT EXISTS idx_meas_aq_time ON measurements(aquarium_id, measured_at DESC);
+CREATE INDEX IF NOT EXISTS idx_meas_aq_time_cov ON measurements(aquarium_id, measured_at DESC)
+    INCLUDE (ph, kh, gh, no2, no3, tan, nh3, nh4, po4, temperature_c);